@@ -1,31 +1,65 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
+from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Query
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple, Optional
 import os
 import json
-import cv2
-import numpy as np
-from PIL import Image
 import uuid
 from pathlib import Path
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event
 import time
 
-from inference import YOLOInference
-from segmentation import create_segmentation_masks
+# torch, ultralytics, cv2 and segment_anything are imported lazily by load_models()
+# so that the service can answer /health while the models are loading
 
 app = FastAPI(title="Power Line Maintenance AI Service", version="1.0.0")
 
 # Initialize the YOLO inference class
 MODEL_PATH = "ai_model\\best.pt"
 print(Path(MODEL_PATH))
-inference = YOLOInference(MODEL_PATH, confidence_threshold=0.4)
+# Optional cheap first-stage model for cascaded detection; frames it does not
+# flag skip the full detector and segmentation
+SCREEN_MODEL_PATH = os.environ.get("SCREEN_MODEL_PATH")
+SCREEN_THRESHOLD = float(os.environ.get("SCREEN_THRESHOLD", "0.25"))
+SAM_DEVICE = os.environ.get("SAM_DEVICE", "cpu")
+
+# Adaptive resolution: a low-resolution pass first, full resolution (or tiles of
+# ADAPTIVE_TILE_SIZE pixels) only for frames with uncertain or small candidates
+ADAPTIVE_INFERENCE = os.environ.get("ADAPTIVE_INFERENCE", "0") == "1"
+ADAPTIVE_LOW_IMGSZ = int(os.environ.get("ADAPTIVE_LOW_IMGSZ", "320"))
+ADAPTIVE_TILE_SIZE = int(os.environ.get("ADAPTIVE_TILE_SIZE", "0")) or None
+
+# Created in the background by load_models()
+inference = None
+# Set once the detector has finished loading (successfully or not)
+detector_ready = Event()
+# Set once every model has finished loading
+models_ready = Event()
+
+# Real state of every model: not_loaded -> loading -> ready | error
+model_status = {
+    "detector": {"status": "not_loaded"},
+    "sam": {"status": "not_loaded"}
+}
 
 
 # Configuration
 SESSIONS_DIR = "../server/sessions"
+# Persistent spatial index of defects across all sessions
+GEO_INDEX_PATH = os.environ.get("GEO_INDEX_PATH", os.path.join(SESSIONS_DIR, "defects_index.sqlite"))
+geo_index = None
+
+def get_geo_index():
+    """
+    Open the spatial defect index on first use
+    """
+    global geo_index
+    if geo_index is None:
+        from geo_index import GeoIndex
+        geo_index = GeoIndex(GEO_INDEX_PATH)
+    return geo_index
 
 # Store processing status
 processing_status = {}
@@ -47,6 +81,71 @@ class SessionAnalysisResponse(BaseModel):
     processed_images: int
     results: List[ImageAnalysisResult]
 
+def load_models():
+    """
+    Import the heavy dependencies, load every model and run a warm-up inference
+    """
+    global inference
+    
+    try:
+        model_status["detector"] = {"status": "loading"}
+        start_time = time.time()
+        from inference import YOLOInference
+        from defect_classes import DEFECT_CLASS_NAMES
+        inference = YOLOInference(
+            MODEL_PATH,
+            confidence_threshold=0.4,
+            screen_model_path=SCREEN_MODEL_PATH,
+            screen_threshold=SCREEN_THRESHOLD,
+            adaptive=ADAPTIVE_INFERENCE,
+            low_res_imgsz=ADAPTIVE_LOW_IMGSZ,
+            escalation_classes=DEFECT_CLASS_NAMES,
+            tile_size=ADAPTIVE_TILE_SIZE
+        )
+        load_time = time.time() - start_time
+        
+        start_time = time.time()
+        inference.warmup()
+        model_status["detector"] = {
+            "status": "ready",
+            "load_seconds": round(load_time, 3),
+            "warmup_seconds": round(time.time() - start_time, 3)
+        }
+        print(f"✅ Detector loaded in {load_time:.1f}s")
+    except Exception as e:
+        print(f"❌ Error loading detector: {str(e)}")
+        model_status["detector"] = {"status": "error", "error": str(e)}
+    
+    detector_ready.set()
+    
+    try:
+        model_status["sam"] = {"status": "loading"}
+        start_time = time.time()
+        from segmentation import load_sam_model, warmup_sam
+        load_sam_model(device=SAM_DEVICE)
+        load_time = time.time() - start_time
+        
+        start_time = time.time()
+        warmup_sam(device=SAM_DEVICE)
+        model_status["sam"] = {
+            "status": "ready",
+            "load_seconds": round(load_time, 3),
+            "warmup_seconds": round(time.time() - start_time, 3)
+        }
+        print(f"✅ SAM loaded in {load_time:.1f}s")
+    except Exception as e:
+        print(f"❌ Error loading SAM: {str(e)}")
+        model_status["sam"] = {"status": "error", "error": str(e)}
+    
+    models_ready.set()
+
+@app.on_event("startup")
+async def start_model_loading():
+    """
+    Load the models in a background thread so that startup is not blocked
+    """
+    Thread(target=load_models, daemon=True).start()
+
 @app.post("/analyze/{session_id}")
 async def analyze_session(session_id: str, background_tasks: BackgroundTasks):
     """
@@ -67,6 +166,9 @@ async def analyze_session(session_id: str, background_tasks: BackgroundTasks):
     if not image_files:
         raise HTTPException(status_code=40, detail="No image files found in session")
     
+    if model_status["detector"]["status"] == "error":
+        raise HTTPException(status_code=503, detail="Detection model failed to load")
+    
     # Initialize processing status
     processing_status[session_id] = {
         "total": len(image_files),
@@ -126,10 +228,13 @@ def process_segmentation_background(session_id: str, session_path: str, results_
             }
         
         # Create segmentation masks
+        models_ready.wait()
+        from segmentation import create_segmentation_masks
         result = create_segmentation_masks(
             session_id=session_id,
             session_path=session_path,
-            results_path=results_path
+            results_path=results_path,
+            device=SAM_DEVICE
         )
         
         # Update segmentation status
@@ -137,6 +242,7 @@ def process_segmentation_background(session_id: str, session_path: str, results_
             "status": "completed",
             "end_time": time.time(),
             "processed_images": result["processed_images"],
+            "skipped_images": result["skipped_images"],
             "total_defects_masked": result["total_defects_masked"],
             "masks_directory": result["masks_directory"]
         })
@@ -172,9 +278,22 @@ def process_images_background(session_id: str, image_files: List[Path]):
     session_path = Path(SESSIONS_DIR) / session_id
     results_path = session_path / "results.json"
     
+    # Requests accepted during startup wait for the detector to finish loading
+    detector_ready.wait()
+    if model_status["detector"]["status"] != "ready":
+        print(f"❌ Detection model is not available, session {session_id} is not processed")
+        processing_status[session_id]["status"] = "error"
+        processing_status[session_id]["error"] = "Detection model failed to load"
+        processing_status[session_id]["end_time"] = time.time()
+        return
+    
+    from defect_classes import DEFECT_CLASS_NAMES
+    from geo_index import read_image_geo
+    
     # Initialize results structure
     results = {
         "image_mapping": {},
+        "geo": {},
         "detections": {},
         "processing_info": {
             "session_id": session_id,
@@ -184,11 +303,42 @@ def process_images_background(session_id: str, image_files: List[Path]):
         }
     }
     
+    # Number of images removed at each stage of the detection cascade
+    cascade_stats = {
+        "screen_model": SCREEN_MODEL_PATH,
+        "screen_threshold": SCREEN_THRESHOLD if SCREEN_MODEL_PATH else None,
+        "removed_by_screen": 0,
+        "removed_by_detector": 0,
+        "removed_before_segmentation": 0,
+        "sent_to_segmentation": 0
+    }
+    
+    # Number of images the adaptive mode escalated to full resolution
+    adaptive_stats = {
+        "enabled": ADAPTIVE_INFERENCE,
+        "low_res_imgsz": ADAPTIVE_LOW_IMGSZ if ADAPTIVE_INFERENCE else None,
+        "tile_size": ADAPTIVE_TILE_SIZE if ADAPTIVE_INFERENCE else None,
+        "escalated_images": 0,
+        "low_res_only_images": 0
+    }
+    
     # Process each image
     for idx, image_path in enumerate(image_files):
         try:
             # Process the image
-            detections = process_single_image(str(image_path))
+            detections, passed_screen, escalated = process_single_image(str(image_path))
+            
+            if ADAPTIVE_INFERENCE and passed_screen:
+                adaptive_stats["escalated_images" if escalated else "low_res_only_images"] += 1
+            
+            if not passed_screen:
+                cascade_stats["removed_by_screen"] += 1
+            elif not detections:
+                cascade_stats["removed_by_detector"] += 1
+            elif not any(d["class"] in DEFECT_CLASS_NAMES for d in detections):
+                cascade_stats["removed_before_segmentation"] += 1
+            else:
+                cascade_stats["sent_to_segmentation"] += 1
             
             # Map original filename to server filename
             # For now, we're using the same filename, but in a real scenario
@@ -197,6 +347,7 @@ def process_images_background(session_id: str, image_files: List[Path]):
             server_filename = image_path.name  # This would be the actual server filename
             
             results["image_mapping"][original_filename] = server_filename
+            results["geo"][server_filename] = read_image_geo(str(image_path))
             results["detections"][server_filename] = detections
             
             # Update processing status
@@ -206,19 +357,47 @@ def process_images_background(session_id: str, image_files: List[Path]):
             print(f"Error processing {image_path}: {str(e)}")
             continue
     
+    # Link detections of the same physical defect across overlapping frames
+    try:
+        from dedup import deduplicate_defects
+        results["defect_groups"] = deduplicate_defects(
+            str(session_path), results["detections"], results["geo"], DEFECT_CLASS_NAMES
+        )
+        results["processing_info"]["unique_defects"] = len(results["defect_groups"])
+        processing_status[session_id]["unique_defects"] = len(results["defect_groups"])
+    except Exception as e:
+        print(f"Error deduplicating defects for session {session_id}: {str(e)}")
+    
     # Update final status
     processing_status[session_id]["status"] = "completed"
     processing_status[session_id]["end_time"] = time.time()
+    processing_status[session_id]["cascade"] = cascade_stats
+    processing_status[session_id]["adaptive"] = adaptive_stats
+    
     results["processing_info"]["status"] = "completed"
+    results["processing_info"]["cascade"] = cascade_stats
+    results["processing_info"]["adaptive"] = adaptive_stats
     results["processing_info"]["end_time"] = time.time()
     
     # Save results to JSON file
     with open(results_path, 'w', encoding='utf-8') as f:
         json.dump(results, f, ensure_ascii=False, indent=2)
     
+    # Add the session's defects to the cross-session spatial index
+    try:
+        image_geo = {name: geo for name, geo in results["geo"].items() if geo is not None}
+        defects = {
+            name: [d for d in detections
+                   if d["class"] in DEFECT_CLASS_NAMES and d.get("is_representative", True)]
+            for name, detections in results["detections"].items()
+        }
+        indexed = get_geo_index().ingest_session(session_id, image_geo, defects)
+        print(f"✅ Indexed {indexed} geolocated defects for session {session_id}")
+    except Exception as e:
+        print(f"Error updating spatial index for session {session_id}: {str(e)}")
+    
     # Automatically trigger segmentation after detection is complete
     try:
-        from threading import Thread
         def run_segmentation():
             import time
             # Add a small delay to ensure the results file is fully written
@@ -236,12 +415,13 @@ def process_images_background(session_id: str, image_files: List[Path]):
     except Exception as e:
         print(f"Error starting segmentation after detection: {str(e)}")
 
-def process_single_image(image_path: str) -> List[Dict[str, Any]]:
+def process_single_image(image_path: str) -> Tuple[List[Dict[str, Any]], bool, bool]:
     """
-    Process a single image and return detection results
+    Process a single image and return detection results, whether it passed the first stage
+    and whether the adaptive mode escalated it to full resolution
     """
     # Use the inference module to process the image
-    detections = inference.process_image(image_path)
+    detections, passed_screen, escalated = inference.process_image_cascaded(image_path)
     
     # Transform the results to the expected format
     formatted_detections = []
@@ -252,7 +432,7 @@ def process_single_image(image_path: str) -> List[Dict[str, Any]]:
             "bbox": detection["bbox"]
         })
     
-    return formatted_detections
+    return formatted_detections, passed_screen, escalated
 
 @app.get("/results/{session_id}")
 async def get_results(session_id: str):
@@ -285,12 +465,43 @@ async def get_status(session_id: str):
         else:
             raise HTTPException(status_code=404, detail="Session not found")
 
+@app.get("/defects/bbox")
+async def get_defects_in_bbox(min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+                              class_name: Optional[List[str]] = Query(None),
+                              last_sessions: Optional[int] = None):
+    """
+    Find geolocated defects of all sessions inside a bounding box
+    """
+    defects = get_geo_index().query_bbox(min_lat, min_lon, max_lat, max_lon, class_name, last_sessions)
+    return JSONResponse(content={"defects": defects})
+
+@app.get("/defects/nearest")
+async def get_nearest_defects(lat: float, lon: float, k: int = 10, max_distance_m: float = 5000,
+                              class_name: Optional[List[str]] = Query(None),
+                              last_sessions: Optional[int] = None):
+    """
+    Find geolocated defects of all sessions nearest to a point, e.g. a pylon
+    """
+    defects = get_geo_index().query_nearest(lat, lon, k, max_distance_m, class_name, last_sessions)
+    return JSONResponse(content={"defects": defects})
+
 @app.get("/health")
 async def health_check():
     """
     Health check endpoint
     """
-    return {"status": "healthy", "model_loaded": True}
+    return {"status": "healthy", "model_loaded": model_status["detector"]["status"] == "ready"}
+
+@app.get("/ready")
+async def readiness_check():
+    """
+    Readiness endpoint reporting the real state and load time of each model
+    """
+    ready = all(state["status"] == "ready" for state in model_status.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "models": model_status}
+    )
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,202 @@
+"""
+This module links detections of the same physical defect across overlapping drone frames
+so that only one representative per defect is segmented and counted.
+"""
+import re
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from defect_classes import DEFECT_CLASS_NAMES
+from geo_index import is_projectable, project_bbox, haversine_m
+
+
+# Frames are matched on images downscaled by this factor
+MATCH_IMREAD_FLAG = cv2.IMREAD_REDUCED_GRAYSCALE_4
+MATCH_SCALE = 4
+MIN_FEATURE_MATCHES = 15
+
+
+def _frame_sort_key(image_name: str, geo: Optional[Dict[str, Any]]):
+    # Server filenames are sequential upload numbers, so sort them numerically
+    stem = Path(image_name).stem
+    number = int(stem) if re.fullmatch(r"\d+", stem) else float("inf")
+    captured_at = geo.get("captured_at") if geo else None
+    return (captured_at is None, captured_at or "", number, image_name)
+
+
+def _bbox_iou(a: List[float], b: List[float]) -> float:
+    ix1, iy1 = max(a[0], b[0]), max(a[1], b[1])
+    ix2, iy2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, ix2 - ix1) * max(0.0, iy2 - iy1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+class _FrameMatcher:
+    """
+    Estimates homographies between frames with ORB features, caching features per frame
+    """
+
+    def __init__(self, session_path: Path):
+        self.session_path = session_path
+        self.orb = cv2.ORB_create(nfeatures=2000)
+        self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        self._features = {}
+        self._homographies = {}
+
+    def _get_features(self, image_name: str):
+        if image_name not in self._features:
+            image = cv2.imread(str(self.session_path / image_name), MATCH_IMREAD_FLAG)
+            self._features[image_name] = (
+                self.orb.detectAndCompute(image, None) if image is not None else (None, None)
+            )
+        return self._features[image_name]
+
+    def homography(self, src_name: str, dst_name: str) -> Optional[np.ndarray]:
+        """
+        Return the homography mapping full-resolution pixels of src to dst, or None
+        """
+        key = (src_name, dst_name)
+        if key in self._homographies:
+            return self._homographies[key]
+
+        H = None
+        src_kp, src_des = self._get_features(src_name)
+        dst_kp, dst_des = self._get_features(dst_name)
+        if src_des is not None and dst_des is not None:
+            matches = self.matcher.match(src_des, dst_des)
+            if len(matches) >= MIN_FEATURE_MATCHES:
+                src_pts = np.float32([src_kp[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
+                dst_pts = np.float32([dst_kp[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
+                H_small, inliers = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
+                if H_small is not None and int(inliers.sum()) >= MIN_FEATURE_MATCHES:
+                    # Convert from downscaled to full-resolution coordinates
+                    scale = np.diag([MATCH_SCALE, MATCH_SCALE, 1.0])
+                    H = scale @ H_small @ np.linalg.inv(scale)
+
+        self._homographies[key] = H
+        return H
+
+
+def _warp_bbox(H: np.ndarray, bbox: List[float]) -> List[float]:
+    x1, y1, x2, y2 = bbox
+    corners = np.float32([[x1, y1], [x2, y1], [x2, y2], [x1, y2]]).reshape(-1, 1, 2)
+    warped = cv2.perspectiveTransform(corners, H).reshape(-1, 2)
+    return [float(warped[:, 0].min()), float(warped[:, 1].min()),
+            float(warped[:, 0].max()), float(warped[:, 1].max())]
+
+
+def deduplicate_defects(
+    session_path: str,
+    detections: Dict[str, List[Dict[str, Any]]],
+    image_geo: Dict[str, Optional[Dict[str, Any]]],
+    defect_class_names: set = DEFECT_CLASS_NAMES,
+    window: int = 2,
+    max_distance_m: float = 3.0,
+    min_iou: float = 0.3
+) -> List[Dict[str, Any]]:
+    """
+    Group detections of the same defect seen in nearby frames.
+
+    Frames are ordered by capture time (or upload order). A detection is linked to a
+    detection of the same class in one of the previous `window` frames when their projected
+    GPS positions are closer than max_distance_m, or, when either frame cannot be projected
+    to the ground (oblique shot, unknown heading), when the earlier bbox warped by the ORB
+    homography between the frames overlaps it. Two detections of the same frame are never
+    put into one group.
+
+    Every defect detection is annotated in place with "group_id" and "is_representative";
+    the representative of a group is its most confident detection.
+
+    Args:
+        session_path: Path to the session directory
+        detections: Detections of every image, as stored in results.json
+        image_geo: Camera position of every image, as returned by geo_index.read_image_geo
+        defect_class_names: Classes to deduplicate (default DEFECT_CLASS_NAMES)
+        window: Number of previous frames to search for the same defect
+        max_distance_m: Maximum distance between GPS positions of the same defect
+        min_iou: Minimum IoU between a warped bbox and the bbox of the same defect
+
+    Returns:
+        List of defect groups with class, representative and members
+    """
+    matcher = _FrameMatcher(Path(session_path))
+    frames = sorted(detections, key=lambda name: _frame_sort_key(name, image_geo.get(name)))
+
+    # Defect detections as (image, index) nodes of a union-find; every root keeps
+    # the frames of its group so that one frame never contributes twice
+    parent = {}
+    group_frames = {}
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def union(node, other):
+        root, other_root = find(node), find(other)
+        if root == other_root or group_frames[root] & group_frames[other_root]:
+            return
+        parent[root] = other_root
+        group_frames[other_root] |= group_frames.pop(root)
+
+    def positions(image_name) -> List[Tuple[int, Optional[Dict[str, float]]]]:
+        geo = image_geo.get(image_name)
+        # Only a real ground projection tells defects of one frame apart
+        located = is_projectable(geo)
+        return [
+            (idx, project_bbox(geo, detection["bbox"]) if located else None)
+            for idx, detection in enumerate(detections[image_name])
+            if detection["class"] in defect_class_names
+        ]
+
+    frame_defects = [positions(name) for name in frames]
+    for name, defects in zip(frames, frame_defects):
+        for idx, _ in defects:
+            parent[(name, idx)] = (name, idx)
+            group_frames[(name, idx)] = {name}
+
+    for i, name in enumerate(frames):
+        for idx, point in frame_defects[i]:
+            detection = detections[name][idx]
+            for j in range(max(0, i - window), i):
+                prev_name = frames[j]
+                for prev_idx, prev_point in frame_defects[j]:
+                    prev_detection = detections[prev_name][prev_idx]
+                    if prev_detection["class"] != detection["class"]:
+                        continue
+
+                    if point is not None and prev_point is not None:
+                        same = haversine_m(point["lat"], point["lon"],
+                                           prev_point["lat"], prev_point["lon"]) <= max_distance_m
+                    else:
+                        H = matcher.homography(prev_name, name)
+                        same = H is not None and _bbox_iou(
+                            _warp_bbox(H, prev_detection["bbox"]), detection["bbox"]
+                        ) >= min_iou
+
+                    if same:
+                        union((name, idx), (prev_name, prev_idx))
+
+    groups = {}
+    for node in parent:
+        groups.setdefault(find(node), []).append(node)
+
+    result = []
+    for group_id, members in enumerate(groups.values()):
+        representative = max(members, key=lambda node: detections[node[0]][node[1]]["confidence"])
+        for image_name, idx in members:
+            detections[image_name][idx]["group_id"] = group_id
+            detections[image_name][idx]["is_representative"] = (image_name, idx) == representative
+        result.append({
+            "id": group_id,
+            "class": detections[representative[0]][representative[1]]["class"],
+            "representative": {"image": representative[0], "detection": representative[1]},
+            "members": [{"image": image_name, "detection": idx} for image_name, idx in members]
+        })
+
+    return result
@@ -0,0 +1,32 @@
+"""
+Defect classes shared by detection, segmentation, deduplication and the batch CLI.
+
+Kept free of torch, ultralytics and segment_anything so that importing it is cheap.
+"""
+from typing import List, Dict, Any, Tuple
+
+# Detection classes that are passed to SAM for segmentation
+DEFECT_CLASS_NAMES = {"bad_insulator", "damaged_insulator", "nest"}
+
+
+def select_segmentation_targets(
+    detections: List[Dict[str, Any]],
+    class_names: set = DEFECT_CLASS_NAMES
+) -> List[Tuple[int, List[float]]]:
+    """
+    Pick the detections of an image that should be segmented.
+
+    Duplicates of a defect already seen in another frame are not segmented again.
+
+    Args:
+        detections: Detections of one image, as stored in results.json
+        class_names: Classes to segment
+
+    Returns:
+        (index in detections, bbox) pairs of the target defects
+    """
+    return [
+        (idx, detection["bbox"])
+        for idx, detection in enumerate(detections)
+        if detection["class"] in class_names and detection.get("is_representative", True)
+    ]
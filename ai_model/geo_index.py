@@ -0,0 +1,336 @@
+"""
+This module reads GPS position of drone images from EXIF/XMP, projects detected defects
+to geographic coordinates and keeps them in a persistent SQLite R-tree index shared by all sessions.
+"""
+import math
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Iterable
+
+from PIL import Image
+
+
+EARTH_RADIUS_M = 6371008.8
+
+# EXIF tag ids
+GPS_INFO_TAG = 0x8825
+EXIF_IFD_TAG = 0x8769
+DATETIME_ORIGINAL_TAG = 0x9003
+FOCAL_LENGTH_35MM_TAG = 0xA405
+
+# DJI and other drones store the flight altitude and camera heading in XMP
+XMP_FIELDS = {
+    "relative_altitude": re.compile(rb'RelativeAltitude="?([-+]?\d+(?:\.\d+)?)'),
+    "gimbal_yaw": re.compile(rb'GimbalYawDegree="?([-+]?\d+(?:\.\d+)?)'),
+    "gimbal_pitch": re.compile(rb'GimbalPitchDegree="?([-+]?\d+(?:\.\d+)?)'),
+    "flight_yaw": re.compile(rb'FlightYawDegree="?([-+]?\d+(?:\.\d+)?)'),
+}
+
+# Only look for XMP in the first part of the file, where the APP1 segments are
+XMP_SCAN_BYTES = 256 * 1024
+
+
+def _dms_to_degrees(dms, ref) -> float:
+    degrees = float(dms[0]) + float(dms[1]) / 60.0 + float(dms[2]) / 3600.0
+    return -degrees if ref in ("S", "W") else degrees
+
+
+def _read_xmp(image_path: Path) -> Dict[str, float]:
+    with open(image_path, 'rb') as f:
+        head = f.read(XMP_SCAN_BYTES)
+
+    values = {}
+    for name, pattern in XMP_FIELDS.items():
+        match = pattern.search(head)
+        if match:
+            values[name] = float(match.group(1))
+    return values
+
+
+def read_image_geo(image_path: str) -> Optional[Dict[str, Any]]:
+    """
+    Read camera position and orientation of an image from EXIF GPS tags and drone XMP
+
+    Args:
+        image_path: Path to the image file
+
+    Returns:
+        Dictionary with lat, lon, altitude, yaw, fov and captured_at,
+        or None if the image has no GPS position
+    """
+    image_path = Path(image_path)
+    try:
+        return _read_image_geo(image_path)
+    except Exception as e:
+        # Malformed EXIF/XMP must not cost the image its detections
+        print(f"⚠️ Could not read GPS data of {image_path.name}: {e}")
+        return None
+
+
+def _read_image_geo(image_path: Path) -> Optional[Dict[str, Any]]:
+    with Image.open(image_path) as img:
+        exif = img.getexif()
+        width, height = img.size
+
+    gps = exif.get_ifd(GPS_INFO_TAG)
+    # 1/2 - latitude ref/value, 3/4 - longitude ref/value, 6 - altitude above sea level
+    if not gps or 2 not in gps or 4 not in gps:
+        return None
+
+    exif_ifd = exif.get_ifd(EXIF_IFD_TAG)
+    xmp = _read_xmp(image_path)
+
+    # Ground projection needs the height above ground, which only XMP provides
+    altitude = xmp.get("relative_altitude")
+    focal_35mm = exif_ifd.get(FOCAL_LENGTH_35MM_TAG)
+
+    return {
+        "lat": _dms_to_degrees(gps[2], gps.get(1, "N")),
+        "lon": _dms_to_degrees(gps[4], gps.get(3, "E")),
+        "absolute_altitude": float(gps[6]) if 6 in gps else None,
+        "altitude": altitude,
+        "yaw": xmp.get("gimbal_yaw", xmp.get("flight_yaw")),
+        "pitch": xmp.get("gimbal_pitch"),
+        # Horizontal field of view from the 35mm-equivalent focal length (36 mm wide frame)
+        "hfov": 2 * math.atan(18.0 / float(focal_35mm)) if focal_35mm else None,
+        "width": width,
+        "height": height,
+        "captured_at": exif_ifd.get(DATETIME_ORIGINAL_TAG)
+    }
+
+
+def is_projectable(geo: Optional[Dict[str, Any]]) -> bool:
+    """
+    Whether bboxes of an image can be projected to the ground
+
+    Requires height above ground, field of view and heading of a camera looking
+    (nearly) straight down.
+    """
+    if geo is None:
+        return False
+    pitch = geo.get("pitch")
+    return (geo.get("altitude") is not None and geo.get("hfov") is not None
+            and geo.get("yaw") is not None and (pitch is None or pitch <= -60))
+
+
+def project_bbox(geo: Dict[str, Any], bbox: List[float]) -> Dict[str, float]:
+    """
+    Project the center of a pixel bbox to geographic coordinates
+
+    The camera is assumed to look straight down (nadir). If altitude, field of view or
+    heading are unknown, or the camera is tilted towards the horizon, the camera position is used.
+
+    Args:
+        geo: Camera position returned by read_image_geo
+        bbox: Bounding box [x1, y1, x2, y2] in pixels
+
+    Returns:
+        Dictionary with lat and lon of the defect
+    """
+    if not is_projectable(geo):
+        return {"lat": geo["lat"], "lon": geo["lon"]}
+    altitude, hfov, yaw = geo["altitude"], geo["hfov"], geo["yaw"]
+
+    # Meters per pixel on the ground
+    gsd = 2 * altitude * math.tan(hfov / 2) / geo["width"]
+
+    x1, y1, x2, y2 = bbox
+    right = ((x1 + x2) / 2 - geo["width"] / 2) * gsd
+    forward = (geo["height"] / 2 - (y1 + y2) / 2) * gsd
+
+    heading = math.radians(yaw)
+    north = forward * math.cos(heading) - right * math.sin(heading)
+    east = forward * math.sin(heading) + right * math.cos(heading)
+
+    lat = geo["lat"] + math.degrees(north / EARTH_RADIUS_M)
+    lon = geo["lon"] + math.degrees(east / (EARTH_RADIUS_M * math.cos(math.radians(geo["lat"]))))
+    return {"lat": lat, "lon": lon}
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Great-circle distance between two points in meters
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+class GeoIndex:
+    def __init__(self, db_path: str):
+        """
+        Open (and create if needed) the persistent defect index
+
+        Args:
+            db_path: Path to the SQLite database file
+        """
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._write_lock = threading.Lock()
+
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    ingested_at REAL NOT NULL,
+                    captured_at TEXT
+                );
+                CREATE TABLE IF NOT EXISTS defects (
+                    id INTEGER PRIMARY KEY,
+                    session_id TEXT NOT NULL,
+                    image TEXT NOT NULL,
+                    class TEXT NOT NULL,
+                    confidence REAL NOT NULL,
+                    lat REAL NOT NULL,
+                    lon REAL NOT NULL,
+                    altitude REAL,
+                    captured_at TEXT,
+                    x1 REAL, y1 REAL, x2 REAL, y2 REAL
+                );
+                CREATE INDEX IF NOT EXISTS defects_session ON defects(session_id);
+                CREATE VIRTUAL TABLE IF NOT EXISTS defects_rtree USING rtree(
+                    id, min_lat, max_lat, min_lon, max_lon
+                );
+            """)
+            # Databases created before captured_at was tracked
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(sessions)")}
+            if "captured_at" not in columns:
+                conn.execute("ALTER TABLE sessions ADD COLUMN captured_at TEXT")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.db_path), timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def ingest_session(self, session_id: str, image_geo: Dict[str, Dict[str, Any]],
+                       detections: Dict[str, List[Dict[str, Any]]]) -> int:
+        """
+        Replace the defects of one session in the index
+
+        Args:
+            session_id: The session ID
+            image_geo: Camera position of every image, as returned by read_image_geo
+            detections: Detections of every image, as stored in results.json
+
+        Returns:
+            Number of defects inserted
+        """
+        rows = []
+        for image, image_detections in detections.items():
+            geo = image_geo.get(image)
+            if geo is None:
+                continue
+            for detection in image_detections:
+                point = project_bbox(geo, detection["bbox"])
+                rows.append((
+                    session_id, image, detection["class"], detection["confidence"],
+                    point["lat"], point["lon"], geo["absolute_altitude"], geo["captured_at"],
+                    *detection["bbox"]
+                ))
+
+        # The flight time of a session is the capture time of its earliest image
+        capture_times = [geo["captured_at"] for geo in image_geo.values() if geo.get("captured_at")]
+        captured_at = min(capture_times) if capture_times else None
+
+        with self._write_lock, self._connect() as conn:
+            conn.execute(
+                "DELETE FROM defects_rtree WHERE id IN (SELECT id FROM defects WHERE session_id = ?)",
+                (session_id,)
+            )
+            conn.execute("DELETE FROM defects WHERE session_id = ?", (session_id,))
+            for row in rows:
+                cursor = conn.execute(
+                    "INSERT INTO defects (session_id, image, class, confidence, lat, lon, altitude, "
+                    "captured_at, x1, y1, x2, y2) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    row
+                )
+                lat, lon = row[4], row[5]
+                conn.execute(
+                    "INSERT INTO defects_rtree VALUES (?, ?, ?, ?, ?)",
+                    (cursor.lastrowid, lat, lat, lon, lon)
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, ingested_at, captured_at) VALUES (?, ?, ?)",
+                (session_id, time.time(), captured_at)
+            )
+
+        return len(rows)
+
+    def _filters(self, class_names: Optional[Iterable[str]], last_sessions: Optional[int]):
+        clauses, params = [], []
+        if class_names:
+            class_names = list(class_names)
+            clauses.append(f"d.class IN ({', '.join('?' * len(class_names))})")
+            params.extend(class_names)
+        if last_sessions:
+            clauses.append(
+                # Flights are ordered by capture time, so re-analysing an old flight does not
+                # make it the newest; sessions without capture time come last
+                "d.session_id IN (SELECT session_id FROM sessions "
+                "ORDER BY captured_at IS NULL, captured_at DESC, ingested_at DESC LIMIT ?)"
+            )
+            params.append(last_sessions)
+        return "".join(f" AND {clause}" for clause in clauses), params
+
+    def query_bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+                   class_names: Optional[Iterable[str]] = None,
+                   last_sessions: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Find defects inside a geographic bounding box
+
+        Args:
+            min_lat, min_lon, max_lat, max_lon: Bounding box in degrees
+            class_names: Optional set of classes to return
+            last_sessions: Only look at the N most recently captured sessions
+
+        Returns:
+            List of defects
+        """
+        extra, params = self._filters(class_names, last_sessions)
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT d.* FROM defects_rtree r JOIN defects d ON d.id = r.id "
+                "WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lon >= ? AND r.max_lon <= ?" + extra,
+                [min_lat, max_lat, min_lon, max_lon] + params
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def query_nearest(self, lat: float, lon: float, k: int = 10, max_distance_m: float = 5000,
+                      class_names: Optional[Iterable[str]] = None,
+                      last_sessions: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Find the defects nearest to a point, e.g. a pylon
+
+        The search window grows until k defects are found or max_distance_m is reached.
+
+        Args:
+            lat, lon: Point in degrees
+            k: Number of defects to return
+            max_distance_m: Search radius limit in meters
+            class_names: Optional set of classes to return
+            last_sessions: Only look at the N most recently captured sessions
+
+        Returns:
+            List of defects sorted by distance, each with distance_m
+        """
+        radius = min(50.0, max_distance_m)
+        while True:
+            dlat = math.degrees(radius / EARTH_RADIUS_M)
+            dlon = math.degrees(radius / (EARTH_RADIUS_M * max(math.cos(math.radians(lat)), 1e-6)))
+            candidates = self.query_bbox(lat - dlat, lon - dlon, lat + dlat, lon + dlon,
+                                         class_names, last_sessions)
+            for defect in candidates:
+                defect["distance_m"] = haversine_m(lat, lon, defect["lat"], defect["lon"])
+            # Only defects inside the inscribed circle are guaranteed to be the nearest ones
+            found = sorted(
+                (defect for defect in candidates if defect["distance_m"] <= radius),
+                key=lambda defect: defect["distance_m"]
+            )
+            if len(found) >= k or radius >= max_distance_m:
+                return found[:k]
+            radius = min(radius * 4, max_distance_m)
@@ -2,20 +2,275 @@ from ultralytics import YOLO
 import cv2
 import numpy as np
 from PIL import Image
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 import os
 
+# Merging of boxes found on overlapping tiles
+TILE_NMS_IOU = 0.5
+# Share of the smaller box covered by the other one for both to be the same object
+TILE_CONTAINMENT = 0.7
+# Boxes this close (in pixels) to an inner tile edge are treated as cut by the tile
+TILE_EDGE_MARGIN = 2
+
+
+def _is_same_object(a: List[float], b: List[float]) -> bool:
+    """
+    Whether two boxes of one class overlap by IoU, or one mostly contains the other
+    """
+    ix1, iy1 = max(a[0], b[0]), max(a[1], b[1])
+    ix2, iy2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, ix2 - ix1) * max(0.0, iy2 - iy1)
+    area_a = (a[2] - a[0]) * (a[3] - a[1])
+    area_b = (b[2] - b[0]) * (b[3] - b[1])
+    union = area_a + area_b - inter
+    smaller = min(area_a, area_b)
+    return (union > 0 and inter / union >= TILE_NMS_IOU) or \
+        (smaller > 0 and inter / smaller >= TILE_CONTAINMENT)
+
+
 class YOLOInference:
-    def __init__(self, model_path: str, confidence_threshold: float = 0.4):
+    def __init__(
+        self,
+        model_path: str,
+        confidence_threshold: float = 0.4,
+        screen_model_path: Optional[str] = None,
+        screen_threshold: float = 0.25,
+        screen_clean_class: str = "clean",
+        adaptive: bool = False,
+        low_res_imgsz: int = 320,
+        full_imgsz: Optional[int] = None,
+        escalation_margin: float = 0.15,
+        small_box_fraction: float = 0.001,
+        escalation_classes: Optional[set] = None,
+        tile_size: Optional[int] = None,
+        tile_overlap: float = 0.2
+    ):
         """
         Initialize the YOLO inference class
         
         Args:
             model_path: Path to the YOLO model file
             confidence_threshold: Minimum confidence for detections (default 0.4)
+            screen_model_path: Optional path to a small first-stage model (detector or
+                classifier). When set, only frames it flags are passed to the full model
+            screen_threshold: Minimum first-stage score for a frame to be flagged (default 0.25)
+            screen_clean_class: Class name of intact frames when the first stage is a classifier
+            adaptive: Run a low-resolution pass first and escalate only uncertain frames
+            low_res_imgsz: Input size of the low-resolution pass (default 320)
+            full_imgsz: Input size of the full-resolution pass and of every tile
+                (default None: the input size the model was trained with)
+            escalation_margin: Candidates within this distance of confidence_threshold
+                cause escalation (default 0.15)
+            small_box_fraction: Boxes of escalation_classes smaller than this fraction of
+                the image area cause escalation (default 0.001)
+            escalation_classes: Classes whose small boxes cause escalation (default all)
+            tile_size: If set, escalated frames larger than this are processed as
+                overlapping tiles of this size instead of one full-resolution pass
+            tile_overlap: Overlap between neighbouring tiles as a fraction of tile_size
         """
         self.model = YOLO(model_path)
         self.confidence_threshold = confidence_threshold
+        self.screen_model = YOLO(screen_model_path) if screen_model_path else None
+        self.screen_threshold = screen_threshold
+        self.screen_clean_class = screen_clean_class
+        self.adaptive = adaptive
+        self.low_res_imgsz = low_res_imgsz
+        self.full_imgsz = full_imgsz
+        self.escalation_margin = escalation_margin
+        self.small_box_fraction = small_box_fraction
+        self.escalation_classes = escalation_classes
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+    
+    def warmup(self, imgsz: int = 640):
+        """
+        Run inference on a dummy image so the first real request does not pay
+        for kernel initialization
+        
+        Args:
+            imgsz: Size of the square dummy image (default 640)
+        """
+        dummy = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+        self.model(dummy, verbose=False)
+        if self.adaptive:
+            self.model(dummy, imgsz=self.low_res_imgsz, verbose=False)
+        if self.screen_model is not None:
+            self.screen_model(dummy, verbose=False)
+    
+    def _full_res_kwargs(self) -> Dict[str, Any]:
+        """
+        Keyword arguments of the full-resolution pass; imgsz is only overridden when
+        full_imgsz is set, otherwise the model keeps its own checkpoint input size
+        """
+        return {"imgsz": self.full_imgsz} if self.full_imgsz else {}
+    
+    def screen_image(self, image) -> bool:
+        """
+        Run the cheap first-stage model and decide whether the frame needs the full detector
+        
+        Args:
+            image: Path to the image file or image as numpy array
+            
+        Returns:
+            True if the frame should be passed to the full detector
+        """
+        if self.screen_model is None:
+            return True
+        
+        # Pass the threshold as conf so that values below the ultralytics default
+        # of 0.25 still keep low-confidence boxes of a detector screen
+        results = self.screen_model(image, conf=self.screen_threshold, verbose=False)
+        
+        for result in results:
+            # Classifier: flag the frame unless it is confidently "clean"
+            if result.probs is not None:
+                probs = result.probs.data.tolist()
+                names = result.names
+                clean_prob = sum(
+                    prob for cls, prob in enumerate(probs)
+                    if names[cls] == self.screen_clean_class
+                )
+                if 1.0 - clean_prob >= self.screen_threshold:
+                    return True
+            # Detector: flag the frame if anything is found above the threshold
+            elif result.boxes is not None and len(result.boxes) > 0:
+                if float(result.boxes.conf.max()) >= self.screen_threshold:
+                    return True
+        
+        return False
+    
+    def process_image_cascaded(self, image_path: str) -> Tuple[List[Dict[str, Any]], bool, bool]:
+        """
+        Process a single image through the first-stage screen and, if flagged, the full detector
+        
+        Args:
+            image_path: Path to the image file
+            
+        Returns:
+            Tuple of (detection results, whether the frame passed the first stage,
+            whether the adaptive mode escalated it to full resolution)
+        """
+        if not self.screen_image(image_path):
+            return [], False, False
+        
+        if self.adaptive:
+            detections, escalated = self.process_image_adaptive(image_path)
+            return detections, True, escalated
+        
+        return self.process_image(image_path), True, False
+    
+    def _extract_detections(self, results, min_confidence: float,
+                            offset: Tuple[int, int] = (0, 0)) -> List[Dict[str, Any]]:
+        """
+        Convert YOLO results to detection dicts, shifting boxes by offset (for tiles)
+        """
+        dx, dy = offset
+        detections = []
+        for result in results:
+            boxes = result.boxes
+            if boxes is None:
+                continue
+            for xyxy, conf, cls in zip(boxes.xyxy.tolist(), boxes.conf.tolist(), boxes.cls.tolist()):
+                if conf >= min_confidence:
+                    x1, y1, x2, y2 = xyxy
+                    detections.append({
+                        "class": self.model.names[int(cls)],
+                        "confidence": float(conf),
+                        "bbox": [x1 + dx, y1 + dy, x2 + dx, y2 + dy]
+                    })
+        return detections
+    
+    def _needs_escalation(self, candidates: List[Dict[str, Any]], image_area: int) -> bool:
+        """
+        Decide whether low-resolution candidates are too uncertain or too small to trust
+        """
+        for candidate in candidates:
+            if abs(candidate["confidence"] - self.confidence_threshold) < self.escalation_margin:
+                return True
+            
+            if self.escalation_classes is None or candidate["class"] in self.escalation_classes:
+                x1, y1, x2, y2 = candidate["bbox"]
+                if (x2 - x1) * (y2 - y1) < self.small_box_fraction * image_area:
+                    return True
+        return False
+    
+    def _process_tiled(self, image: np.ndarray) -> List[Dict[str, Any]]:
+        """
+        Run the detector on overlapping tiles and merge the boxes of the same object
+        
+        An object crossing a tile edge shows up as a truncated box in one tile and,
+        when it fits into the overlap, as a whole box in the neighbouring one. Boxes
+        that do not touch an inner tile edge are therefore kept first, and a box is
+        dropped when it overlaps a kept box of its class by IoU or lies mostly inside it.
+        """
+        H, W = image.shape[:2]
+        step = max(1, int(self.tile_size * (1 - self.tile_overlap)))
+        ys = list(range(0, max(H - self.tile_size, 0) + 1, step))
+        xs = list(range(0, max(W - self.tile_size, 0) + 1, step))
+        # Make sure the last row and column of tiles reach the image border
+        if ys[-1] + self.tile_size < H:
+            ys.append(H - self.tile_size)
+        if xs[-1] + self.tile_size < W:
+            xs.append(W - self.tile_size)
+        
+        detections = []
+        truncated = []
+        for y in ys:
+            for x in xs:
+                tile = image[y:y + self.tile_size, x:x + self.tile_size]
+                results = self.model(tile, verbose=False, **self._full_res_kwargs())
+                tile_detections = self._extract_detections(results, self.confidence_threshold, (x, y))
+                detections.extend(tile_detections)
+                truncated.extend(self._touches_inner_edge(d["bbox"], x, y, W, H) for d in tile_detections)
+        
+        order = sorted(range(len(detections)), key=lambda i: (truncated[i], -detections[i]["confidence"]))
+        merged = []
+        for i in order:
+            detection = detections[i]
+            if not any(kept["class"] == detection["class"] and _is_same_object(kept["bbox"], detection["bbox"])
+                       for kept in merged):
+                merged.append(detection)
+        return merged
+    
+    def _touches_inner_edge(self, bbox: List[float], x: int, y: int, W: int, H: int) -> bool:
+        """
+        Whether a box found on the tile at (x, y) touches a tile edge that is not the image border
+        """
+        x1, y1, x2, y2 = bbox
+        return ((x > 0 and x1 <= x + TILE_EDGE_MARGIN)
+                or (y > 0 and y1 <= y + TILE_EDGE_MARGIN)
+                or (x + self.tile_size < W and x2 >= x + self.tile_size - TILE_EDGE_MARGIN)
+                or (y + self.tile_size < H and y2 >= y + self.tile_size - TILE_EDGE_MARGIN))
+    
+    def process_image_adaptive(self, image_path: str) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        Run a low-resolution pass and escalate to full resolution (or tiles) only when
+        it finds candidates near the confidence threshold or small boxes
+        
+        Args:
+            image_path: Path to the image file
+            
+        Returns:
+            Tuple of (detection results, whether the frame was escalated)
+        """
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f"Could not load image: {image_path}")
+        H, W = image.shape[:2]
+        
+        # Keep candidates below the threshold so that near misses can trigger escalation
+        min_confidence = max(0.01, self.confidence_threshold - self.escalation_margin)
+        results = self.model(image, imgsz=self.low_res_imgsz, conf=min_confidence, verbose=False)
+        candidates = self._extract_detections(results, min_confidence)
+        
+        if not self._needs_escalation(candidates, H * W):
+            return [c for c in candidates if c["confidence"] >= self.confidence_threshold], False
+        
+        if self.tile_size and max(H, W) > self.tile_size:
+            return self._process_tiled(image), True
+        
+        results = self.model(image, verbose=False, **self._full_res_kwargs())
+        return self._extract_detections(results, self.confidence_threshold), True
     
     def process_image(self, image_path: str) -> List[Dict[str, Any]]:
         """
@@ -68,8 +323,9 @@ class YOLOInference:
         Returns:
             List of detection results
         """
-        # Run YOLOv8 inference
-        results = self.model(image_array)
+        # Run YOLOv8 inference; ultralytics drops boxes below its own default conf (0.25),
+        # so pass the threshold explicitly, and keep the per-image log quiet for batch runs
+        results = self.model(image_array, conf=self.confidence_threshold, verbose=False)
         
         detections = []
         
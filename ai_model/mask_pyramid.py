@@ -0,0 +1,183 @@
+"""
+This module builds downscaled levels and per-defect crops of segmentation masks
+so that the server can serve the smallest mask that still fits the requested size.
+"""
+import json
+import struct
+import zlib
+from pathlib import Path
+from typing import List, Dict, Any, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+
+# Widths (in pixels) of the downscaled levels generated for every mask
+DEFAULT_LEVEL_WIDTHS = (256, 512, 1024, 2048)
+
+# Number of mask rows converted to RGBA and compressed at a time
+DEFAULT_STRIP_ROWS = 64
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return (struct.pack(">I", len(data)) + chunk_type + data
+            + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+
+def write_mask_png(
+    mask: np.ndarray,
+    output_path: Path,
+    strip_rows: int = DEFAULT_STRIP_ROWS,
+    compression: int = 9
+):
+    """
+    Write a mask as a red RGBA PNG with transparent background, strip by strip.
+
+    Only one strip of RGBA rows exists at a time, so the memory used does not depend
+    on the frame size beyond the mask itself.
+
+    Args:
+        mask: Boolean mask (H x W) or uint8 alpha (H x W, 0-255)
+        output_path: Path of the PNG file
+        strip_rows: Number of rows converted and compressed at a time
+        compression: zlib compression level (0-9)
+    """
+    H, W = mask.shape
+    # Run-length strategy suits masks: long runs of identical pixels
+    compressor = zlib.compressobj(compression, zlib.DEFLATED, 15, 9, zlib.Z_RLE)
+
+    # Each PNG row is a filter byte (0 = none) followed by RGBA pixels in RGBA order;
+    # green and blue stay 0, red is 255 wherever the mask is set and alpha carries
+    # the mask coverage (partial on the edges of downscaled levels)
+    strip = np.zeros((strip_rows, 1 + W * 4), dtype=np.uint8)
+    pixels = strip[:, 1:].reshape(strip_rows, W, 4)
+
+    with open(output_path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        # 8 bits per channel, color type 6 (RGBA)
+        f.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", W, H, 8, 6, 0, 0, 0)))
+
+        for y in range(0, H, strip_rows):
+            rows = min(strip_rows, H - y)
+            alpha = mask[y:y + rows]
+            if alpha.dtype == bool:
+                np.multiply(alpha, np.uint8(255), out=pixels[:rows, :, 3])
+            else:
+                pixels[:rows, :, 3] = alpha
+            np.multiply(pixels[:rows, :, 3] > 0, np.uint8(255), out=pixels[:rows, :, 0])
+
+            data = compressor.compress(strip[:rows])
+            if data:
+                f.write(_png_chunk(b"IDAT", data))
+
+        f.write(_png_chunk(b"IDAT", compressor.flush()))
+        f.write(_png_chunk(b"IEND", b""))
+
+
+def _downscale_mask(mask: np.ndarray, width: int, height: int,
+                    strip_rows: int = DEFAULT_STRIP_ROWS) -> np.ndarray:
+    """
+    Area-downscale a boolean mask to a uint8 alpha level, about strip_rows source rows at a time
+    """
+    H, W = mask.shape
+    level = np.empty((height, width), dtype=np.uint8)
+    out_strip_rows = max(1, strip_rows * height // H)
+    for y in range(0, height, out_strip_rows):
+        rows = min(out_strip_rows, height - y)
+        src_y1 = round(y * H / height)
+        src_y2 = round((y + rows) * H / height)
+        # INTER_AREA averages the covered pixels, which keeps thin defects visible
+        source = mask[src_y1:src_y2].view(np.uint8) * np.uint8(255)
+        level[y:y + rows] = cv2.resize(source, (width, rows), interpolation=cv2.INTER_AREA)
+    return level
+
+
+def get_manifest_path(mask_path: Path) -> Path:
+    """
+    Return the path of the pyramid manifest that belongs to a mask file
+
+    Args:
+        mask_path: Path to the full-resolution *_mask.png file
+
+    Returns:
+        Path to the *_mask.json manifest next to the mask
+    """
+    return mask_path.with_suffix(".json")
+
+
+def build_mask_pyramid(
+    mask: np.ndarray,
+    mask_path: Path,
+    defects: List[Tuple[int, List[float]]],
+    level_widths: Sequence[int] = DEFAULT_LEVEL_WIDTHS,
+    crop_padding: float = 0.25
+) -> Dict[str, Any]:
+    """
+    Write downscaled levels and bbox crops of a mask and a manifest describing them.
+
+    Args:
+        mask: Full-resolution boolean mask (H x W)
+        mask_path: Path where the full-resolution mask was saved
+        defects: (detection index, bbox) pairs; the bbox is [x1, y1, x2, y2] in
+            full-resolution pixels and the index is the position of the detection in
+            results.json, which names the crop
+        level_widths: Target widths of the downscaled levels
+        crop_padding: Padding around each bbox, as a fraction of the bbox size
+
+    Returns:
+        The manifest that was written next to the mask
+    """
+    mask_path = Path(mask_path)
+    masks_path = mask_path.parent
+    stem = mask_path.stem
+    H, W = mask.shape
+
+    # Remove levels and crops left over from a previous build of this mask
+    for stale in list(masks_path.glob(f"{stem}_w*.png")) + list(masks_path.glob(f"{stem}_crop*.png")):
+        stale.unlink()
+
+    levels = [{"width": W, "height": H, "file": mask_path.name}]
+    level = None
+    # Largest level first; each smaller level is downscaled from the previous one
+    for level_width in sorted(set(level_widths), reverse=True):
+        if level_width >= W:
+            continue
+        level_height = max(1, round(H * level_width / W))
+        if level is None:
+            level = _downscale_mask(mask, level_width, level_height)
+        else:
+            level = cv2.resize(level, (level_width, level_height), interpolation=cv2.INTER_AREA)
+        level_name = f"{stem}_w{level_width}.png"
+        write_mask_png(level, masks_path / level_name)
+        levels.append({"width": level_width, "height": level_height, "file": level_name})
+
+    crops = []
+    for idx, bbox in defects:
+        x1, y1, x2, y2 = bbox
+        pad_x = (x2 - x1) * crop_padding
+        pad_y = (y2 - y1) * crop_padding
+        cx1 = max(0, int(x1 - pad_x))
+        cy1 = max(0, int(y1 - pad_y))
+        cx2 = min(W, int(np.ceil(x2 + pad_x)))
+        cy2 = min(H, int(np.ceil(y2 + pad_y)))
+        if cx2 <= cx1 or cy2 <= cy1:
+            continue
+
+        crop_name = f"{stem}_crop{idx}.png"
+        write_mask_png(mask[cy1:cy2, cx1:cx2], masks_path / crop_name)
+        # Crops are looked up by detection index, since other classes, duplicates
+        # and degenerate boxes get no crop
+        crops.append({"index": idx, "bbox": [cx1, cy1, cx2, cy2], "file": crop_name})
+
+    manifest = {
+        "width": W,
+        "height": H,
+        "levels": sorted(levels, key=lambda level: level["width"]),
+        "crops": crops
+    }
+    with open(get_manifest_path(mask_path), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    return manifest
@@ -1,11 +1,173 @@
-import os
+"""
+CLI для пакетной офлайн-обработки архивов: детекция + сегментация.
+
+Пример:
+    python seg_file.py ../data/images --masks-dir ../data/masks \
+        --output ../data/detections_and_masks.json --model ../complete/best.pt --workers 4
+
+Результаты по каждому изображению сразу дописываются в <output>.jsonl,
+поэтому прерванный запуск можно продолжить флагом --resume.
+В конце из .jsonl потоково собирается итоговый COCO JSON.
+"""
+import argparse
 import json
+import os
+import time
+from multiprocessing import Pool
 from pathlib import Path
+
 import cv2
 import numpy as np
-from PIL import Image
-from ultralytics import YOLO
-from segment_anything import sam_model_registry, SamPredictor
+from segment_anything import SamPredictor
+
+from defect_classes import DEFECT_CLASS_NAMES
+from inference import YOLOInference
+from segmentation import load_sam_model, segment_defects
+
+
+# Поддерживаемые расширения
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp'}
+
+# CLI запускается из папки ai_model, в отличие от сервиса
+SAM_CHECKPOINT = "sam_vit_b_01ec64.pth"
+
+# Движки инференса, по одному на процесс-воркер
+_inference = None
+_sam_predictor = None
+_masks_path = None
+_target_class_names = None
+
+
+def _init_worker(model_path, sam_checkpoint, conf_threshold, device, masks_dir, target_class_names):
+    """
+    Загружает YOLO и SAM один раз на процесс-воркер.
+    """
+    global _inference, _sam_predictor, _masks_path, _target_class_names
+
+    _inference = YOLOInference(model_path, confidence_threshold=conf_threshold)
+    _sam_predictor = SamPredictor(load_sam_model(sam_checkpoint, device))
+    _masks_path = Path(masks_dir)
+    _target_class_names = set(target_class_names)
+
+
+def _process_image(img_path):
+    """
+    Детекция и сегментация одного изображения в процессе-воркере.
+
+    Возвращает запись для .jsonl: описание изображения и его аннотации (без id),
+    либо запись с "error", чтобы одно сбойное изображение не останавливало весь запуск.
+    """
+    img_path = Path(img_path)
+    try:
+        return _detect_and_segment(img_path)
+    except Exception as e:
+        return {"file_name": img_path.name, "error": str(e)}
+
+
+def _detect_and_segment(img_path):
+    """
+    Детекция YOLO, сегментация целевых классов SAM и сохранение маски.
+    """
+    image = cv2.imread(str(img_path))
+    if image is None:
+        return {"file_name": img_path.name, "error": "не удалось загрузить изображение"}
+
+    height, width = image.shape[:2]
+    mask_name = f"{img_path.stem}_mask.png"
+    class_ids = {name: cls for cls, name in _inference.model.names.items()}
+
+    detections = _inference.process_image_from_array(image)
+
+    annotations = []
+    seg_boxes = []
+    for detection in detections:
+        x1, y1, x2, y2 = detection["bbox"]
+        annotations.append({
+            "category_id": class_ids[detection["class"]],
+            "bbox": [round(x1), round(y1), round(x2 - x1), round(y2 - y1)],
+            "score": detection["confidence"]
+        })
+
+        # Если класс целевой — сегментируем
+        if detection["class"] in _target_class_names:
+            seg_boxes.append(detection["bbox"])
+
+    if seg_boxes:
+        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        combined_mask, _ = segment_defects(_sam_predictor, image_rgb, seg_boxes, image_name=img_path.name)
+
+        # Сохраняем маску (0/255)
+        mask_to_save = combined_mask.view(np.uint8) * np.uint8(255)
+        cv2.imwrite(str(_masks_path / mask_name), mask_to_save)
+
+    return {
+        "image": {
+            "file_name": img_path.name,
+            "mask_name": mask_name,
+            "width": width,
+            "height": height
+        },
+        "annotations": annotations
+    }
+
+
+def _load_done_images(jsonl_path):
+    """
+    Читает уже обработанные изображения из .jsonl для продолжения работы.
+
+    Недописанная последняя строка (после аварийной остановки) обрезается.
+    """
+    done = set()
+    if not jsonl_path.exists():
+        return done
+
+    valid_size = 0
+    with open(jsonl_path, 'rb') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            done.add(record["image"]["file_name"])
+            valid_size += len(line)
+
+    with open(jsonl_path, 'r+b') as f:
+        f.truncate(valid_size)
+
+    return done
+
+
+def _write_coco(jsonl_path, output_json_path):
+    """
+    Потоково собирает итоговый COCO JSON из .jsonl, не держа его целиком в памяти.
+
+    Возвращает (число изображений, число аннотаций).
+    """
+    image_count = 0
+    annotation_count = 0
+
+    with open(output_json_path, 'w', encoding='utf-8') as out:
+        out.write('{"images": [')
+        with open(jsonl_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                image = dict(record["image"], id=image_count)
+                out.write((",\n" if image_count else "\n") + json.dumps(image, ensure_ascii=False))
+                image_count += 1
+
+        out.write('\n], "annotations": [')
+        with open(jsonl_path, 'r', encoding='utf-8') as f:
+            img_id = 0
+            for line in f:
+                record = json.loads(line)
+                for annotation in record["annotations"]:
+                    annotation = dict(annotation, id=annotation_count, image_id=img_id)
+                    out.write((",\n" if annotation_count else "\n") + json.dumps(annotation, ensure_ascii=False))
+                    annotation_count += 1
+                img_id += 1
+        out.write('\n]}\n')
+
+    return image_count, annotation_count
 
 
 def process_and_segment(
@@ -13,13 +175,16 @@ def process_and_segment(
         masks_dir,
         output_json_path,
         model_path,
-        sam_checkpoint="sam_vit_b_01ec64.pth",
-        target_classes={5, 6},
+        sam_checkpoint=SAM_CHECKPOINT,
+        target_class_names=DEFECT_CLASS_NAMES,
         conf_threshold=0.25,
-        device="cpu"  # или "cuda"
+        device="cpu",  # или "cuda"
+        workers=1,
+        resume=False,
+        report_every=100
 ):
     """
-    Полный пайплайн: детекция + сегментация для целевых классов (5, 6).
+    Полный пайплайн: детекция + сегментация для целевых классов.
 
     Параметры:
         images_dir (str): Папка с изображениями
@@ -27,146 +192,109 @@ def process_and_segment(
         output_json_path (str): Путь к выходному JSON
         model_path (str): Путь к YOLO .pt файлу
         sam_checkpoint (str): Путь к весам SAM
-        target_classes (set): Классы, для которых делать сегментацию
+        target_class_names (set): Классы, для которых делать сегментацию
         conf_threshold (float): Порог уверенности YOLO
         device (str): "cpu" или "cuda"
+        workers (int): Число процессов-воркеров
+        resume (bool): Пропустить изображения, уже записанные в <output>.jsonl
+        report_every (int): Как часто (в изображениях) печатать пропускную способность
     """
+    if workers <= 0 or report_every <= 0:
+        raise ValueError("workers и report_every должны быть положительными")
+
     # === Подготовка ===
     images_path = Path(images_dir)
     masks_path = Path(masks_dir)
     masks_path.mkdir(parents=True, exist_ok=True)
-
-    # Поддерживаемые расширения
-    image_extensions = {'.jpg', '.jpeg', '.png', '.bmp'}
-    image_files = [f for f in images_path.iterdir() if f.suffix.lower() in image_extensions]
-    image_files.sort()
-
-    # === Загрузка моделей ===
-    print("🔁 Загружаем YOLO...")
-    yolo_model = YOLO(model_path)
-
-    print("🔁 Загружаем SAM...")
-    sam = sam_model_registry["vit_b"](checkpoint=sam_checkpoint)
-    sam.to(device=device)
-    sam_predictor = SamPredictor(sam)
-
-    # === Этап 1: Детекция и формирование JSON ===
-    coco_output = {"images": [], "annotations": []}
-    annotation_id = 0
-
-    # Словарь для хранения bbox'ов целевых классов по image_id (для сегментации)
-    seg_tasks = {}  # {image_id: [{"bbox": [...], "category_id": ...}, ...]}
-
-    for img_id, img_path in enumerate(image_files, start=0):
-        with Image.open(img_path) as img:
-            width, height = img.size
-
-        mask_name = f"{img_path.stem}_mask.png"
-
-        coco_output["images"].append({
-            "id": img_id,
-            "file_name": img_path.name,
-            "mask_name": mask_name,
-            "width": width,
-            "height": height
-        })
-
-        # YOLO инференс
-        results = yolo_model(str(img_path), conf=conf_threshold)
-        result = results[0]
-
-        current_seg_boxes = []
-
-        if result.boxes is not None and len(result.boxes) > 0:
-            boxes_xyxy = result.boxes.xyxy.cpu().numpy()
-            classes = result.boxes.cls.cpu().numpy()
-            confidences = result.boxes.conf.cpu().numpy()
-
-            for box, cls, conf in zip(boxes_xyxy, classes, confidences):
-                x1, y1, x2, y2 = box
-                w, h = x2 - x1, y2 - y1
-                bbox_coco = [round(x1), round(y1), round(w), round(h)]
-
-                # Добавляем аннотацию в JSON
-                coco_output["annotations"].append({
-                    "id": annotation_id,
-                    "image_id": img_id,
-                    "category_id": int(cls),
-                    "bbox": bbox_coco,
-                    "score": float(conf)
-                })
-
-                # Если класс целевой — запоминаем для сегментации
-                if int(cls) in target_classes:
-                    current_seg_boxes.append({
-                        "bbox": bbox_coco,
-                        "category_id": int(cls)
-                    })
-
-                annotation_id += 1
-
-        # Сохраняем задачи сегментации для этого изображения
-        if current_seg_boxes:
-            seg_tasks[img_id] = current_seg_boxes
-
-    # Сохраняем JSON
-    with open(output_json_path, "w", encoding="utf-8") as f:
-        json.dump(coco_output, f, indent=2, ensure_ascii=False)
-
-    print(f"✅ Детекция завершена. JSON сохранён: {output_json_path}")
-    print(f"📦 Всего аннотаций: {len(coco_output['annotations'])}")
-    print(f"🔍 Изображений для сегментации (классы {sorted(target_classes)}): {len(seg_tasks)}")
-
-    # === Этап 2: Сегментация масок с помощью SAM ===
-    images_by_id = {img["id"]: img for img in coco_output["images"]}
-
-    for img_id, boxes_list in seg_tasks.items():
-        img_info = images_by_id[img_id]
-        image_path = images_path / img_info["file_name"]
-        mask_path = masks_path / img_info["mask_name"]
-
-        # Загружаем изображение
-        image = cv2.imread(str(image_path))
-        if image is None:
-            print(f"⚠️ Не удалось загрузить {image_path}")
-            continue
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-        # Устанавливаем в SAM
-        sam_predictor.set_image(image_rgb)
-
-        H, W = image_rgb.shape[:2]
-        combined_mask = np.zeros((H, W), dtype=np.uint8)
-
-        for box_data in boxes_list:
-            x, y, w, h = box_data["bbox"]
-            x_min, y_min = int(x), int(y)
-            x_max, y_max = int(x + w), int(y + h)
-            input_box = np.array([x_min, y_min, x_max, y_max])
-
-            try:
-                masks, _, _ = sam_predictor.predict(box=input_box, multimask_output=False)
-                mask = masks[0]
-                combined_mask = np.logical_or(combined_mask, mask)
-            except Exception as e:
-                print(f"❌ Ошибка сегментации на {img_info['file_name']}, bbox {input_box}: {e}")
-                continue
-
-        # Сохраняем маску (0/255)
-        mask_to_save = (combined_mask * 255).astype(np.uint8)
-        cv2.imwrite(str(mask_path), mask_to_save)
-        print(f"✅ Маска сохранена: {mask_path.name}")
-
+    jsonl_path = Path(f"{output_json_path}.jsonl")
+
+    done = _load_done_images(jsonl_path) if resume else set()
+    if not resume and jsonl_path.exists():
+        jsonl_path.unlink()
+
+    # os.scandir не создаёт Path для каждого файла каталога
+    image_files = sorted(
+        entry.path for entry in os.scandir(images_path)
+        if entry.is_file() and Path(entry.name).suffix.lower() in IMAGE_EXTENSIONS and entry.name not in done
+    )
+
+    print(f"🔍 К обработке: {len(image_files)} изображений, уже готово: {len(done)}")
+
+    # === Детекция и сегментация, результаты сразу пишутся в .jsonl ===
+    init_args = (model_path, sam_checkpoint, conf_threshold, device, str(masks_path), sorted(target_class_names))
+    processed = 0
+    errors = 0
+    start_time = time.time()
+
+    with Pool(processes=workers, initializer=_init_worker, initargs=init_args) as pool, \
+            open(jsonl_path, 'a', encoding='utf-8') as jsonl:
+        # Изображения раздаются воркерам порциями, порядок результатов не важен
+        chunksize = max(1, min(32, len(image_files) // (workers * 4) or 1))
+        for record in pool.imap_unordered(_process_image, image_files, chunksize=chunksize):
+            processed += 1
+            # Ошибочные изображения не записываются, чтобы --resume повторил их
+            if "error" in record:
+                print(f"⚠️ Ошибка обработки {record['file_name']}: {record['error']}")
+                errors += 1
+            else:
+                jsonl.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+            # Считаются все попытки, в том числе ошибочные, чтобы отчёт не пропускался
+            if processed % report_every == 0:
+                jsonl.flush()
+                elapsed = time.time() - start_time
+                print(f"⏱️ {processed}/{len(image_files)} изображений, {processed / elapsed:.2f} изобр./с")
+
+    elapsed = time.time() - start_time
+    if processed:
+        print(f"⏱️ Обработано {processed} изображений за {elapsed:.1f} с ({processed / elapsed:.2f} изобр./с)")
+
+    # === Сборка итогового COCO JSON ===
+    image_count, annotation_count = _write_coco(jsonl_path, output_json_path)
+
+    print(f"✅ JSON сохранён: {output_json_path}")
+    print(f"📦 Изображений: {image_count}, аннотаций: {annotation_count}, ошибок: {errors}")
     print(f"\n🎉 Всё завершено! Маски сохранены в: {masks_dir}")
 
 
-process_and_segment(
-    images_dir="../data/images",
-    masks_dir="../data/masks",
-    output_json_path="../data/detections_and_masks.json",
-    model_path="../complete/best.pt",
-    sam_checkpoint="sam_vit_b_01ec64.pth",
-    target_classes={5, 6},
-    conf_threshold=0.3,
-    device="cpu"  # или "cuda" если есть GPU
-)
\ No newline at end of file
+def _positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"ожидается положительное число, получено {value}")
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пакетная детекция и сегментация изображений")
+    parser.add_argument("images_dir", help="Папка с изображениями")
+    parser.add_argument("--masks-dir", required=True, help="Папка для сохранения масок")
+    parser.add_argument("--output", required=True, help="Путь к выходному COCO JSON")
+    parser.add_argument("--model", required=True, help="Путь к YOLO .pt файлу")
+    parser.add_argument("--sam-checkpoint", default=SAM_CHECKPOINT, help="Путь к весам SAM")
+    parser.add_argument("--target-classes", nargs="+", default=sorted(DEFECT_CLASS_NAMES),
+                        help="Имена классов для сегментации")
+    parser.add_argument("--conf", type=float, default=0.25, help="Порог уверенности YOLO")
+    parser.add_argument("--device", default="cpu", help='"cpu" или "cuda"')
+    parser.add_argument("--workers", type=_positive_int, default=1, help="Число процессов-воркеров")
+    parser.add_argument("--resume", action="store_true", help="Продолжить прерванный запуск")
+    parser.add_argument("--report-every", type=_positive_int, default=100,
+                        help="Как часто печатать пропускную способность")
+    args = parser.parse_args()
+
+    process_and_segment(
+        images_dir=args.images_dir,
+        masks_dir=args.masks_dir,
+        output_json_path=args.output,
+        model_path=args.model,
+        sam_checkpoint=args.sam_checkpoint,
+        target_class_names=set(args.target_classes),
+        conf_threshold=args.conf,
+        device=args.device,
+        workers=args.workers,
+        resume=args.resume,
+        report_every=args.report_every
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,17 +4,104 @@ from pathlib import Path
 import cv2
 import numpy as np
 from PIL import Image
-from ultralytics import YOLO
 from segment_anything import sam_model_registry, SamPredictor
 from typing import List, Dict, Any
 import time
+import threading
+
+from defect_classes import DEFECT_CLASS_NAMES, select_segmentation_targets
+from mask_pyramid import build_mask_pyramid, write_mask_png
+
+DEFAULT_SAM_CHECKPOINT = "ai_model/sam_vit_b_01ec64.pth"
+
+# Loaded SAM models keyed by (checkpoint, device), shared between sessions
+_sam_models = {}
+_sam_models_lock = threading.Lock()
+
+
+def load_sam_model(sam_checkpoint: str = DEFAULT_SAM_CHECKPOINT, device: str = "cpu"):
+    """
+    Load a SAM model once and reuse it for all later calls.
+    
+    Args:
+        sam_checkpoint: Path to SAM model checkpoint
+        device: Device to run SAM on ("cpu" or "cuda")
+    
+    Returns:
+        The loaded SAM model
+    """
+    key = (sam_checkpoint, device)
+    with _sam_models_lock:
+        if key not in _sam_models:
+            print("🔁 Загружаем SAM...")
+            sam = sam_model_registry["vit_b"](checkpoint=sam_checkpoint)
+            sam.to(device=device)
+            _sam_models[key] = sam
+        return _sam_models[key]
+
+
+def warmup_sam(sam_checkpoint: str = DEFAULT_SAM_CHECKPOINT, device: str = "cpu"):
+    """
+    Run the SAM image encoder once on a dummy image to initialize the kernels.
+    
+    Args:
+        sam_checkpoint: Path to SAM model checkpoint
+        device: Device to run SAM on ("cpu" or "cuda")
+    """
+    sam_predictor = SamPredictor(load_sam_model(sam_checkpoint, device))
+    sam_predictor.set_image(np.zeros((64, 64, 3), dtype=np.uint8))
+    sam_predictor.predict(box=np.array([8, 8, 56, 56]), multimask_output=False)
+
+
+def segment_defects(
+    sam_predictor: SamPredictor,
+    image_rgb: np.ndarray,
+    bboxes: List[List[float]],
+    image_name: str = ""
+):
+    """
+    Segment every bbox of an image with SAM and combine the results into one mask.
+    
+    Args:
+        sam_predictor: SAM predictor to use
+        image_rgb: Image as RGB numpy array
+        bboxes: Bounding boxes [x1, y1, x2, y2] to segment
+        image_name: Image name used in error messages
+    
+    Returns:
+        Tuple of (combined boolean mask, number of successfully segmented bboxes)
+    """
+    # Set image for SAM predictor
+    sam_predictor.set_image(image_rgb)
+    
+    # One preallocated boolean buffer; every SAM mask is OR-ed into it in place
+    H, W = image_rgb.shape[:2]
+    combined_mask = np.zeros((H, W), dtype=bool)
+    defects_masked = 0
+    
+    # Process each target detection with SAM
+    for bbox in bboxes:
+        x1, y1, x2, y2 = map(int, bbox)
+        input_box = np.array([x1, y1, x2, y2])
+        
+        try:
+            masks, _, _ = sam_predictor.predict(box=input_box, multimask_output=False)
+            if len(masks) > 0:
+                mask = masks[0]
+                np.logical_or(combined_mask, mask, out=combined_mask)
+                defects_masked += 1
+        except Exception as e:
+            print(f"❌ Error segmenting {image_name}, bbox {input_box}: {e}")
+            continue
+    
+    return combined_mask, defects_masked
 
 
 def create_segmentation_masks(
     session_id: str,
     session_path: str,
     results_path: str,
-    sam_checkpoint: str = "ai_model/sam_vit_b_01ec64.pth",
+    sam_checkpoint: str = DEFAULT_SAM_CHECKPOINT,
     target_classes: set = {5, 6, 7},  # Default to classes 5 and 6 as in the original seg_file.py
     device: str = "cpu"
 ) -> Dict[str, Any]:
@@ -40,27 +127,30 @@ def create_segmentation_masks(
     with open(results_path, 'r', encoding='utf-8') as f:
         results = json.load(f)
     
-    # Determine target classes based on class names if needed
-    # For now, we'll assume that bad_insulator and nest are the target classes
-    # We need to map class names to the appropriate class IDs
-    # Based on the project, let's assume bad_insulator might be class 5 and nest might be class 6
-    # But we'll also check by class name in case the IDs are different
-    target_class_names = {"bad_insulator", "damaged_insulator", "nest"}  # Add any other defect classes
+    # Target defects are matched by class name, see DEFECT_CLASS_NAMES
+    target_class_names = DEFECT_CLASS_NAMES
     
-    # Load SAM model
-    print("🔁 Загружаем SAM...")
-    sam = sam_model_registry["vit_b"](checkpoint=sam_checkpoint)
-    sam.to(device=device)
-    sam_predictor = SamPredictor(sam)
+    # Load SAM model (cached between sessions); every call gets its own predictor
+    # because the predictor holds the embedding of the current image
+    sam_predictor = SamPredictor(load_sam_model(sam_checkpoint, device))
     
     # Process each image in the session
     processed_images = 0
+    skipped_images = 0
     total_defects = 0
     
     for image_filename, detections in results["detections"].items():
         image_path = session_path / image_filename
         mask_path = masks_path / f"{Path(image_filename).stem}_mask.png"
         
+        # Find target defects in detections, keeping their index for the crop manifest
+        target_detections = select_segmentation_targets(detections, target_class_names)
+        
+        # Only defect frames are worth the SAM image encoder
+        if not target_detections:
+            skipped_images += 1
+            continue
+        
         if not image_path.exists():
             print(f"⚠️ Image not found: {image_path}")
             continue
@@ -72,54 +162,25 @@ def create_segmentation_masks(
             continue
         image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         
-        # Set image for SAM predictor
-        sam_predictor.set_image(image_rgb)
-        
-        H, W = image_rgb.shape[:2]
-        combined_mask = np.zeros((H, W), dtype=np.uint8)
-        
-        # Find target defects in detections
-        target_detections = []
-        for detection in detections:
-            class_name = detection["class"]
-            bbox = detection["bbox"]
-            
-            # Check if this is a target class (by name or ID)
-            if class_name in target_class_names:
-                target_detections.append(bbox)
-        
-        # Process each target detection with SAM
-        for bbox in target_detections:
-            x1, y1, x2, y2 = map(int, bbox)
-            input_box = np.array([x1, y1, x2, y2])
-            
-            try:
-                masks, _, _ = sam_predictor.predict(box=input_box, multimask_output=False)
-                if len(masks) > 0:
-                    mask = masks[0]
-                    combined_mask = np.logical_or(combined_mask, mask)
-                    total_defects += 1
-            except Exception as e:
-                print(f"❌ Error segmenting {image_filename}, bbox {input_box}: {e}")
-                continue
+        combined_mask, defects_masked = segment_defects(
+            sam_predictor, image_rgb, [bbox for _, bbox in target_detections],
+            image_name=image_filename
+        )
+        total_defects += defects_masked
         
-        # Create a 4-channel image (RGBA) with red mask and transparent background
-        # Create an RGBA image where red channel has the mask, and alpha channel controls transparency
-        h, w = combined_mask.shape
-        rgba_mask = np.zeros((h, w, 4), dtype=np.uint8)
-        rgba_mask[:, :, 0] = combined_mask * 255  # Red channel (red color for defects)
-        rgba_mask[:, :, 1] = 0  # Green channel (0 for red color)
-        rgba_mask[:, :, 2] = 0  # Blue channel (0 for red color)
-        rgba_mask[:, :, 3] = combined_mask * 255  # Alpha channel (255=opaque, 0=transparent for black pixels)
+        # Save as RGBA PNG (red mask, transparent background), written in row strips
+        # straight from the boolean buffer to avoid full-frame RGBA temporaries
+        write_mask_png(combined_mask, mask_path)
         
-        # Save as PNG with transparency
-        cv2.imwrite(str(mask_path), rgba_mask, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+        # Cache downscaled levels and per-defect crops for size-aware serving
+        build_mask_pyramid(combined_mask, mask_path, target_detections)
         processed_images += 1
         print(f"✅ Mask saved: {mask_path.name}")
     
     return {
         "status": "completed",
         "processed_images": processed_images,
+        "skipped_images": skipped_images,
         "total_defects_masked": total_defects,
         "masks_directory": str(masks_path)
     }
@@ -0,0 +1,99 @@
+import sys
+import tracemalloc
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from defect_classes import select_segmentation_targets  # noqa: E402
+from mask_pyramid import build_mask_pyramid, write_mask_png  # noqa: E402
+
+
+# 40 MP frame, the size of a full-resolution drone photo
+FRAME_HEIGHT, FRAME_WIDTH = 5000, 8000
+
+# Memory allowed on top of the mask buffer itself; a full-frame RGBA array
+# alone would be 160 MB and a uint8 copy of the mask 40 MB
+PEAK_MEMORY_LIMIT = 16 * 1024 * 1024
+
+
+def _large_mask() -> np.ndarray:
+    mask = np.zeros((FRAME_HEIGHT, FRAME_WIDTH), dtype=bool)
+    mask[1000:3000, 2000:6000] = True
+    mask[4200:4204, :] = True
+    return mask
+
+
+def _read_rgba(path: Path) -> np.ndarray:
+    bgra = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    return cv2.cvtColor(bgra, cv2.COLOR_BGRA2RGBA)
+
+
+def test_write_mask_png_is_red_with_mask_as_alpha(tmp_path):
+    mask = np.zeros((300, 500), dtype=bool)
+    mask[50:120, 100:400] = True
+    write_mask_png(mask, tmp_path / "a_mask.png")
+
+    rgba = _read_rgba(tmp_path / "a_mask.png")
+    assert rgba.shape == (300, 500, 4)
+    assert (rgba[mask] == [255, 0, 0, 255]).all()
+    assert (rgba[~mask] == [0, 0, 0, 0]).all()
+
+
+def test_levels_keep_full_red_and_scale_alpha(tmp_path):
+    mask = np.zeros((1000, 3000), dtype=bool)
+    # Edges that do not fall on level pixel boundaries
+    mask[101:333, 501:1777] = True
+    manifest = build_mask_pyramid(mask, tmp_path / "a_mask.png", [])
+
+    level = _read_rgba(tmp_path / manifest["levels"][0]["file"])
+    alpha = level[:, :, 3]
+    assert ((alpha > 0) & (alpha < 255)).any()
+    assert (level[alpha > 0][:, 0] == 255).all()
+    assert (level[:, :, 1:3] == 0).all()
+
+
+def test_crops_are_indexed_by_detection(tmp_path):
+    mask = np.zeros((600, 1200), dtype=bool)
+    (tmp_path / "a_mask_crop9.png").touch()
+    defects = [(0, [10, 10, 100, 100]), (1, [5, 5, 5, 5]), (2, [200, 200, 300, 300])]
+    manifest = build_mask_pyramid(mask, tmp_path / "a_mask.png", defects)
+
+    assert [crop["index"] for crop in manifest["crops"]] == [0, 2]
+    assert manifest["crops"][1]["file"] == "a_mask_crop2.png"
+    assert not (tmp_path / "a_mask_crop9.png").exists()
+
+
+def test_crop_index_skips_filtered_detections(tmp_path):
+    detections = [
+        {"class": "tower", "bbox": [0, 0, 50, 50]},
+        {"class": "nest", "bbox": [20, 20, 60, 60], "is_representative": False},
+        {"class": "nest", "bbox": [300, 100, 400, 200], "is_representative": True},
+    ]
+    defects = select_segmentation_targets(detections)
+    assert defects == [(2, [300, 100, 400, 200])]
+
+    manifest = build_mask_pyramid(np.zeros((600, 1200), dtype=bool), tmp_path / "a_mask.png", defects)
+    assert manifest["crops"] == [{"index": 2, "bbox": [275, 75, 425, 225], "file": "a_mask_crop2.png"}]
+    assert (tmp_path / "a_mask_crop2.png").exists()
+
+
+def test_peak_memory_is_bounded_on_large_frames(tmp_path):
+    mask = _large_mask()
+    mask_path = tmp_path / "big_mask.png"
+
+    tracemalloc.start()
+    try:
+        write_mask_png(mask, mask_path)
+        build_mask_pyramid(mask, mask_path, [(0, [2000, 1000, 6000, 3000]), (1, [0, 4100, 8000, 4300])])
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert peak < PEAK_MEMORY_LIMIT
+
+    rgba = _read_rgba(mask_path)
+    assert rgba.shape == (FRAME_HEIGHT, FRAME_WIDTH, 4)
+    assert np.array_equal(rgba[:, :, 3] == 255, mask)
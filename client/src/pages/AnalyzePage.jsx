@@ -345,7 +345,12 @@ const AnalyzePage = () => {
     try {
       const apiUrl = process.env.REACT_APP_API_URL || 'http://localhost:5000';
       const maskFilename = `${filename.split('.')[0]}_mask.png`;
-      const maskUrl = `${apiUrl}/sessions/${sessionId}/masks/${maskFilename}`;
+      // Request a mask level that matches the rendered image size instead of full resolution
+      const renderedWidth = imageRef.current ? imageRef.current.clientWidth : 0;
+      const requestedWidth = Math.round(renderedWidth * (window.devicePixelRatio || 1));
+      const maskUrl = requestedWidth > 0
+        ? `${apiUrl}/sessions/${sessionId}/masks/${maskFilename}?width=${requestedWidth}`
+        : `${apiUrl}/sessions/${sessionId}/masks/${maskFilename}`;
       
       // Check if mask exists by trying to fetch it
       const response = await fetch(maskUrl);
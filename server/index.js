@@ -197,13 +197,50 @@ app.get('/sessions/:sessionId/files/:filename', (req, res) => {
     res.sendFile(filePath);
 });
 
+// Выбор уровня пирамиды маски по запрошенному размеру
+// ?width=N  - наименьший уровень, ширина которого не меньше N
+// ?crop=i   - вырезка вокруг i-й детекции изображения (индекс в results.json)
+const selectMaskVariant = (masksDir, filename, query) => {
+    const manifestPath = path.join(masksDir, `${path.parse(filename).name}.json`);
+    if (!fs.existsSync(manifestPath)) {
+        return filename;
+    }
+
+    const manifest = JSON.parse(fs.readFileSync(manifestPath, 'utf8'));
+
+    if (query.crop !== undefined) {
+        const cropIndex = parseInt(query.crop, 10);
+        const crop = manifest.crops.find(c => c.index === cropIndex);
+        return crop ? crop.file : null;
+    }
+
+    const requestedWidth = parseInt(query.width, 10);
+    if (!requestedWidth || requestedWidth <= 0) {
+        return filename;
+    }
+
+    // Уровни отсортированы по возрастанию ширины, последний - полное разрешение
+    const level = manifest.levels.find(l => l.width >= requestedWidth)
+        || manifest.levels[manifest.levels.length - 1];
+    return level.file;
+};
+
 // Получение маски сегментации для изображения
 app.get('/sessions/:sessionId/masks/:filename', (req, res) => {
     const sessionId = req.params.sessionId;
     const filename = req.params.filename;
-    const maskPath = path.join(sessionsDir, sessionId, 'masks', filename);
+    const masksDir = path.join(sessionsDir, sessionId, 'masks');
+
+    let variant;
+    try {
+        variant = selectMaskVariant(masksDir, filename, req.query);
+    } catch (e) {
+        console.error('Ошибка чтения пирамиды маски:', e);
+        variant = filename;
+    }
 
-    if (!fs.existsSync(maskPath)) {
+    const maskPath = variant && path.join(masksDir, variant);
+    if (!maskPath || !fs.existsSync(maskPath)) {
         return res.status(404).json({ error: 'Маска не найдена' });
     }
 